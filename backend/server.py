@@ -1,14 +1,28 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, UploadFile, File, Form, status
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, UploadFile, File, Form, Header, Query, status
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, PlainTextResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.staticfiles import StaticFiles
 from dotenv import load_dotenv
+from starlette.datastructures import Headers, MutableHeaders, QueryParams
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import monitoring
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
 import os
+import sys
+import hmac
+import json
+import hashlib
+import asyncio
+import time
+import random
 import logging
+import threading
+from contextvars import ContextVar
 from pathlib import Path
 from pydantic import BaseModel, Field, EmailStr
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Awaitable, Callable, Tuple
 import uuid
 from datetime import datetime, timedelta
 import jwt
@@ -23,9 +37,95 @@ load_dotenv(ROOT_DIR / '.env')
 UPLOAD_DIR = ROOT_DIR / "uploads"
 UPLOAD_DIR.mkdir(exist_ok=True)
 
+# Profiling
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', '0'))
+PROFILE_SLOW_THRESHOLD_MS = float(os.environ.get('PROFILE_SLOW_THRESHOLD_MS', '500'))
+PROFILE_INTERVAL_MS = float(os.environ.get('PROFILE_INTERVAL_MS', '1'))
+PROFILE_RETENTION_DAYS = int(os.environ.get('PROFILE_RETENTION_DAYS', '7'))
+
+class RequestProfile:
+    """Stack sampler and MongoDB command log for a single request.
+
+    A daemon thread samples the event loop thread's stack every
+    PROFILE_INTERVAL_MS and aggregates the samples as folded stacks, the
+    format consumed by flamegraph.pl and speedscope. Other requests running
+    on the same loop at the same time show up in the samples as well.
+    """
+
+    def __init__(self, method: str, path: str, reason: str):
+        self.id = str(uuid.uuid4())
+        self.method = method
+        self.path = path
+        self.reason = reason
+        self.stacks: Dict[str, int] = {}
+        self.mongo_commands: List[Dict[str, Any]] = []
+        self._pending_commands: Dict[int, Dict[str, Any]] = {}
+        self._thread_id = threading.get_ident()
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+
+    def start(self):
+        self._sampler.start()
+
+    def stop(self):
+        self._stop.set()
+        self._sampler.join()
+
+    def _sample(self):
+        interval = PROFILE_INTERVAL_MS / 1000
+        while not self._stop.wait(interval):
+            frame = sys._current_frames().get(self._thread_id)
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if names:
+                stack = ";".join(reversed(names))
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+    def command_started(self, event):
+        command = {
+            "command": event.command_name,
+            "collection": event.command.get(event.command_name),
+            "duration_ms": None,
+            "succeeded": None,
+        }
+        self._pending_commands[event.request_id] = command
+        self.mongo_commands.append(command)
+
+    def command_finished(self, event, succeeded: bool):
+        command = self._pending_commands.pop(event.request_id, None)
+        if command is not None:
+            command["duration_ms"] = event.duration_micros / 1000
+            command["succeeded"] = succeeded
+
+    def folded(self) -> str:
+        return "\n".join(f"{stack} {count}" for stack, count in self.stacks.items())
+
+_active_profile: ContextVar[Optional[RequestProfile]] = ContextVar("active_profile", default=None)
+
+class ProfilingCommandListener(monitoring.CommandListener):
+    """Attributes MongoDB commands to the request profile active in the current context."""
+
+    def started(self, event):
+        profile = _active_profile.get()
+        if profile is not None:
+            profile.command_started(event)
+
+    def succeeded(self, event):
+        profile = _active_profile.get()
+        if profile is not None:
+            profile.command_finished(event, True)
+
+    def failed(self, event):
+        profile = _active_profile.get()
+        if profile is not None:
+            profile.command_finished(event, False)
+
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(mongo_url, event_listeners=[ProfilingCommandListener()])
 db = client[os.environ['DB_NAME']]
 
 # Security
@@ -33,6 +133,20 @@ SECRET_KEY = os.environ.get('SECRET_KEY', 'your-secret-key-change-in-production'
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30 * 24 * 60  # 30 days
 
+# Idempotency
+IDEMPOTENCY_KEY_TTL_HOURS = int(os.environ.get('IDEMPOTENCY_KEY_TTL_HOURS', '24'))
+IDEMPOTENCY_WAIT_SECONDS = float(os.environ.get('IDEMPOTENCY_WAIT_SECONDS', '30'))
+IDEMPOTENCY_POLL_SECONDS = 0.1
+IDEMPOTENCY_COMPLETE_ATTEMPTS = 3
+
+# Audit log
+AUDIT_BATCH_SIZE = int(os.environ.get('AUDIT_BATCH_SIZE', '100'))
+AUDIT_FLUSH_SECONDS = float(os.environ.get('AUDIT_FLUSH_SECONDS', '1'))
+AUDIT_BUFFER_MAX = int(os.environ.get('AUDIT_BUFFER_MAX', '10000'))
+AUDIT_BACKPRESSURE_SECONDS = float(os.environ.get('AUDIT_BACKPRESSURE_SECONDS', '2'))
+AUDIT_WRITE_ATTEMPTS = 5
+AUDIT_RETRY_BACKOFF_SECONDS = 0.5
+
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 security = HTTPBearer()
 
@@ -67,6 +181,13 @@ class ShiftPosition(str, Enum):
     PATHOLOGY = "แพทย์พยาธิวิทยา"
     PSYCHIATRY = "แพทย์จิตเวชศาสตร์"
 
+class AuditAction(str, Enum):
+    USER_REGISTERED = "user_registered"
+    USER_APPROVED = "user_approved"
+    USER_REJECTED = "user_rejected"
+    SHIFT_CREATED = "shift_created"
+    SHIFT_DELETED = "shift_deleted"
+
 # Models
 class UserBase(BaseModel):
     email: EmailStr
@@ -96,6 +217,8 @@ class User(BaseModel):
     created_at: datetime = Field(default_factory=datetime.utcnow)
     approved_at: Optional[datetime] = None
     approved_by: Optional[str] = None
+    rejected_at: Optional[datetime] = None
+    rejected_by: Optional[str] = None
 
 class UserResponse(BaseModel):
     id: str
@@ -147,6 +270,16 @@ class Shift(BaseModel):
     created_at: datetime = Field(default_factory=datetime.utcnow)
     is_active: bool = True
 
+class RequestProfileResponse(BaseModel):
+    id: str
+    method: str
+    path: str
+    reason: str
+    status_code: int
+    duration_ms: float
+    mongo_commands: List[Dict[str, Any]]
+    created_at: datetime
+
 class ShiftResponse(BaseModel):
     id: str
     doctor_id: str
@@ -164,6 +297,14 @@ class ShiftResponse(BaseModel):
     created_at: datetime
     is_active: bool
 
+class AuditEventResponse(BaseModel):
+    id: str
+    action: AuditAction
+    actor_id: str
+    target_id: str
+    details: Dict[str, Any] = {}
+    created_at: datetime
+
 # Utility functions
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
@@ -181,6 +322,274 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+# Completion signals for requests executing in this process, so concurrent
+# duplicates wake up once instead of polling MongoDB.
+_idempotency_events: Dict[Tuple[str, str], asyncio.Event] = {}
+
+def request_fingerprint(*parts: bytes) -> str:
+    """Keyed hash of a request payload, used to reject reused Idempotency-Keys.
+
+    HMAC keeps the stored value from being brute-forced back to a password.
+    """
+    digest = hmac.new(SECRET_KEY.encode(), digestmod=hashlib.sha256)
+    for part in parts:
+        digest.update(len(part).to_bytes(8, "big"))
+        digest.update(part)
+    return digest.hexdigest()
+
+async def wait_for_idempotent_response(scope: str, key: str, locked_until: datetime) -> Optional[dict]:
+    """Wait for the in-flight original request.
+
+    An original running in this process is waited on until it finishes,
+    however long that takes. One running elsewhere is polled until its lease
+    expires. Returns the record as it stands afterwards, or None if the
+    original released its claim.
+    """
+    event = _idempotency_events.get((scope, key))
+    if event is not None:
+        await event.wait()
+        return await db.idempotency_keys.find_one({"scope": scope, "key": key})
+
+    # The original is running in another process
+    remaining = (locked_until - datetime.utcnow()).total_seconds()
+    deadline = time.monotonic() + remaining
+    while True:
+        await asyncio.sleep(max(min(IDEMPOTENCY_POLL_SECONDS, deadline - time.monotonic()), 0))
+        record = await db.idempotency_keys.find_one({"scope": scope, "key": key})
+        if record is None or record["status"] == "completed" or time.monotonic() >= deadline:
+            return record
+
+def replay_idempotent_response(record: dict) -> JSONResponse:
+    return JSONResponse(
+        status_code=record["status_code"],
+        content=record["body"],
+        headers={"Idempotent-Replayed": "true"}
+    )
+
+async def claim_idempotency_key(scope: str, key: str, fingerprint: str) -> Tuple[Optional[str], Optional[dict]]:
+    """Claim (scope, key) for execution or fetch the completed response.
+
+    Returns (claim_id, None) when the caller should execute the request, or
+    (None, record) when a completed response should be replayed. A claim
+    whose lease has expired, because its process died, is taken over.
+    """
+    record = await db.idempotency_keys.find_one({"scope": scope, "key": key})
+    while True:
+        claim_id = str(uuid.uuid4())
+        now = datetime.utcnow()
+        locked_until = now + timedelta(seconds=IDEMPOTENCY_WAIT_SECONDS)
+        if record is None:
+            try:
+                await db.idempotency_keys.insert_one({
+                    "scope": scope,
+                    "key": key,
+                    "fingerprint": fingerprint,
+                    "status": "in_progress",
+                    "claim_id": claim_id,
+                    "locked_until": locked_until,
+                    "created_at": now
+                })
+                return claim_id, None
+            except DuplicateKeyError:
+                record = await db.idempotency_keys.find_one({"scope": scope, "key": key})
+                continue
+
+        if record["fingerprint"] != fingerprint:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail="Idempotency-Key was already used with a different request"
+            )
+        if record["status"] == "completed":
+            return None, record
+
+        if record["locked_until"] <= now and (scope, key) not in _idempotency_events:
+            taken = await db.idempotency_keys.find_one_and_update(
+                {
+                    "scope": scope,
+                    "key": key,
+                    "claim_id": record["claim_id"],
+                    "status": "in_progress",
+                    "locked_until": {"$lte": now}
+                },
+                {"$set": {"claim_id": claim_id, "locked_until": locked_until}}
+            )
+            if taken is not None:
+                return claim_id, None
+            record = await db.idempotency_keys.find_one({"scope": scope, "key": key})
+        else:
+            record = await wait_for_idempotent_response(scope, key, record["locked_until"])
+
+async def renew_idempotency_lease(scope: str, key: str, claim_id: str):
+    """Extend the claim's lease while its handler runs, until cancelled."""
+    claim = {"scope": scope, "key": key, "claim_id": claim_id}
+    while True:
+        await asyncio.sleep(IDEMPOTENCY_WAIT_SECONDS / 3)
+        locked_until = datetime.utcnow() + timedelta(seconds=IDEMPOTENCY_WAIT_SECONDS)
+        try:
+            result = await db.idempotency_keys.update_one(claim, {"$set": {"locked_until": locked_until}})
+        except PyMongoError:
+            logger.warning("Failed to renew Idempotency-Key lease for %s", scope)
+            continue
+        if result.matched_count == 0:
+            logger.warning("Lost Idempotency-Key claim for %s while its request was running", scope)
+            return
+
+async def complete_idempotent_request(scope: str, key: str, claim_id: str, status_code: int, body: Any):
+    claim = {"scope": scope, "key": key, "claim_id": claim_id}
+    for attempt in range(IDEMPOTENCY_COMPLETE_ATTEMPTS):
+        try:
+            result = await db.idempotency_keys.update_one(
+                claim,
+                {"$set": {"status": "completed", "status_code": status_code, "body": body}}
+            )
+            if result.matched_count == 0:
+                logger.warning("Lost Idempotency-Key claim for %s, response was not stored", scope)
+            return
+        except PyMongoError:
+            logger.warning("Failed to store idempotent response for %s (attempt %d)", scope, attempt + 1)
+    # Without a stored response, release the key rather than leaving retries
+    # waiting on a claim that will never complete
+    await release_idempotency_key(scope, key, claim_id)
+
+async def release_idempotency_key(scope: str, key: str, claim_id: str):
+    try:
+        await db.idempotency_keys.delete_one({"scope": scope, "key": key, "claim_id": claim_id})
+    except PyMongoError:
+        # The lease expires after IDEMPOTENCY_WAIT_SECONDS and retries take over
+        logger.exception("Failed to release Idempotency-Key for %s", scope)
+
+async def run_idempotent(key: Optional[str], scope: str, fingerprint: str, handler: Callable[[], Awaitable[Any]]):
+    """Execute handler at most once per (scope, Idempotency-Key).
+
+    The first response, including HTTPException errors, is stored and
+    replayed for retries with the same key and payload. Unexpected failures
+    release the key so the client can retry.
+    """
+    if not key:
+        return await handler()
+
+    claim_id, record = await claim_idempotency_key(scope, key, fingerprint)
+    if record is not None:
+        return replay_idempotent_response(record)
+
+    event = _idempotency_events[(scope, key)] = asyncio.Event()
+    heartbeat = asyncio.create_task(renew_idempotency_lease(scope, key, claim_id))
+    try:
+        try:
+            result = await handler()
+        except HTTPException as exc:
+            await complete_idempotent_request(scope, key, claim_id, exc.status_code, {"detail": exc.detail})
+            raise
+        except BaseException:
+            await release_idempotency_key(scope, key, claim_id)
+            raise
+        await complete_idempotent_request(scope, key, claim_id, 200, jsonable_encoder(result))
+        return result
+    finally:
+        heartbeat.cancel()
+        event.set()
+        if _idempotency_events.get((scope, key)) is event:
+            del _idempotency_events[(scope, key)]
+
+class AuditLog:
+    """Write-behind buffer for audit events.
+
+    Events are queued in memory and written with insert_many by a background
+    task once AUDIT_BATCH_SIZE events are buffered or AUDIT_FLUSH_SECONDS
+    have passed. Failed writes are retried with backoff while new events
+    keep queueing; when the buffer is full, emit waits up to
+    AUDIT_BACKPRESSURE_SECONDS before dropping the event.
+    """
+
+    def __init__(self):
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._queue = asyncio.Queue(maxsize=AUDIT_BUFFER_MAX)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        task, self._task = self._task, None
+        if task.done():
+            return
+        # The sentinel is queued behind pending events, so they are flushed first
+        await self._queue.put(None)
+        await task
+
+    async def emit(self, action: AuditAction, actor_id: str, target_id: str, **details):
+        event = {
+            "id": str(uuid.uuid4()),
+            "action": action,
+            "actor_id": actor_id,
+            "target_id": target_id,
+            "details": details,
+            "created_at": datetime.utcnow()
+        }
+        if self._queue is None:
+            logger.warning("Audit log not started, dropping %s event for %s", action.value, target_id)
+            return
+        try:
+            await asyncio.wait_for(self._queue.put(event), AUDIT_BACKPRESSURE_SECONDS)
+        except asyncio.TimeoutError:
+            logger.warning("Audit buffer full, dropping %s event for %s", action.value, target_id)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            event = await self._queue.get()
+            if event is None:
+                return
+            batch = [event]
+            deadline = loop.time() + AUDIT_FLUSH_SECONDS
+            stopping = False
+            while len(batch) < AUDIT_BATCH_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    event = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if event is None:
+                    stopping = True
+                    break
+                batch.append(event)
+            await self._write(batch)
+            if stopping:
+                return
+
+    async def _write(self, batch: List[dict]):
+        for attempt in range(AUDIT_WRITE_ATTEMPTS):
+            try:
+                await db.audit_events.insert_many(batch, ordered=False)
+                return
+            except BulkWriteError as exc:
+                # The rest of the unordered batch was inserted. Duplicate _ids
+                # are expected when a retried batch had partly succeeded.
+                logger.warning("%d audit events were not written: %s", len(exc.details["writeErrors"]), exc)
+                return
+            except PyMongoError:
+                if attempt + 1 == AUDIT_WRITE_ATTEMPTS:
+                    logger.exception("Failed to write %d audit events, dropping them", len(batch))
+                    return
+                logger.warning("Failed to write %d audit events (attempt %d), retrying", len(batch), attempt + 1)
+                await asyncio.sleep(AUDIT_RETRY_BACKOFF_SECONDS * 2 ** attempt)
+            except Exception:
+                # Not retryable, e.g. an event that cannot be BSON encoded. Split
+                # the batch so only the bad events are dropped.
+                if len(batch) == 1:
+                    logger.exception("Dropping unwritable audit event %s", batch[0]["id"])
+                    return
+                middle = len(batch) // 2
+                await self._write(batch[:middle])
+                await self._write(batch[middle:])
+                return
+
+audit_log = AuditLog()
+
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -226,8 +635,31 @@ async def register(
     last_name: str = Form(...),
     phone_number: str = Form(...),
     medical_license_number: str = Form(...),
-    license_image: UploadFile = File(...)
+    license_image: UploadFile = File(...),
+    idempotency_key: Optional[str] = Header(None)
 ):
+    fingerprint = None
+    if idempotency_key:
+        fields = [email, password, first_name, last_name, phone_number, medical_license_number, license_image.filename]
+        fingerprint = request_fingerprint(json.dumps(fields).encode(), await license_image.read())
+        await license_image.seek(0)
+    # Scoped by email so a key reused by another client cannot replay this user
+    return await run_idempotent(
+        idempotency_key,
+        f"register:{email}",
+        fingerprint,
+        lambda: register_user(email, password, first_name, last_name, phone_number, medical_license_number, license_image)
+    )
+
+async def register_user(
+    email: str,
+    password: str,
+    first_name: str,
+    last_name: str,
+    phone_number: str,
+    medical_license_number: str,
+    license_image: UploadFile
+) -> UserResponse:
     # Check if user already exists
     existing_user = await db.users.find_one({"email": email})
     if existing_user:
@@ -268,6 +700,7 @@ async def register(
     }
     
     await db.users.insert_one(user_data)
+    await audit_log.emit(AuditAction.USER_REGISTERED, user_data["id"], user_data["id"], email=email)
     
     # Remove password from response
     user_data.pop("password")
@@ -317,23 +750,86 @@ async def approve_user(user_id: str, admin_user: User = Depends(get_current_admi
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="User not found")
     
+    await audit_log.emit(AuditAction.USER_APPROVED, admin_user.id, user_id)
     return {"message": "User approved successfully"}
 
 @api_router.post("/admin/reject-user/{user_id}")
 async def reject_user(user_id: str, admin_user: User = Depends(get_current_admin)):
     result = await db.users.update_one(
         {"id": user_id},
-        {"$set": {"approval_status": ApprovalStatus.REJECTED}}
+        {
+            "$set": {
+                "approval_status": ApprovalStatus.REJECTED,
+                "rejected_at": datetime.utcnow(),
+                "rejected_by": admin_user.id
+            }
+        }
     )
     
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="User not found")
     
+    await audit_log.emit(AuditAction.USER_REJECTED, admin_user.id, user_id)
     return {"message": "User rejected"}
 
+@api_router.get("/admin/audit-events", response_model=List[AuditEventResponse])
+async def get_audit_events(
+    action: Optional[AuditAction] = None,
+    actor_id: Optional[str] = None,
+    target_id: Optional[str] = None,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    skip: int = Query(0, ge=0),
+    limit: int = Query(50, ge=1, le=500),
+    admin_user: User = Depends(get_current_admin)
+):
+    filter_query = {}
+    
+    if action:
+        filter_query["action"] = action
+    if actor_id:
+        filter_query["actor_id"] = actor_id
+    if target_id:
+        filter_query["target_id"] = target_id
+    if date_from or date_to:
+        filter_query["created_at"] = {}
+        if date_from:
+            filter_query["created_at"]["$gte"] = date_from
+        if date_to:
+            filter_query["created_at"]["$lte"] = date_to
+    
+    events = await db.audit_events.find(filter_query).sort([("created_at", -1), ("_id", -1)]).skip(skip).limit(limit).to_list(limit)
+    return [AuditEventResponse(**event) for event in events]
+
+@api_router.get("/admin/profiles/{profile_id}", response_model=RequestProfileResponse)
+async def get_request_profile(profile_id: str, admin_user: User = Depends(get_current_admin)):
+    profile = await db.request_profiles.find_one({"id": profile_id})
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return RequestProfileResponse(**profile)
+
+@api_router.get("/admin/profiles/{profile_id}/folded", response_class=PlainTextResponse)
+async def get_request_profile_folded(profile_id: str, admin_user: User = Depends(get_current_admin)):
+    profile = await db.request_profiles.find_one({"id": profile_id}, {"folded": 1})
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return profile["folded"]
+
 # Shift Routes
 @api_router.post("/shifts", response_model=ShiftResponse)
-async def create_shift(shift_data: ShiftCreate, current_user: User = Depends(get_current_approved_user)):
+async def create_shift(
+    shift_data: ShiftCreate,
+    current_user: User = Depends(get_current_approved_user),
+    idempotency_key: Optional[str] = Header(None)
+):
+    return await run_idempotent(
+        idempotency_key,
+        f"create_shift:{current_user.id}",
+        request_fingerprint(shift_data.json().encode()) if idempotency_key else None,
+        lambda: insert_shift(shift_data, current_user)
+    )
+
+async def insert_shift(shift_data: ShiftCreate, current_user: User) -> ShiftResponse:
     shift_dict = shift_data.dict()
     shift_dict.update({
         "id": str(uuid.uuid4()),
@@ -344,6 +840,7 @@ async def create_shift(shift_data: ShiftCreate, current_user: User = Depends(get
     })
     
     await db.shifts.insert_one(shift_dict)
+    await audit_log.emit(AuditAction.SHIFT_CREATED, current_user.id, shift_dict["id"])
     return ShiftResponse(**shift_dict)
 
 @api_router.get("/shifts", response_model=List[ShiftResponse])
@@ -386,6 +883,7 @@ async def delete_shift(shift_id: str, current_user: User = Depends(get_current_a
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Shift not found or not authorized")
     
+    await audit_log.emit(AuditAction.SHIFT_DELETED, current_user.id, shift_id)
     return {"message": "Shift deleted successfully"}
 
 # Create admin user if not exists
@@ -416,12 +914,110 @@ async def create_admin():
 # Include the router in the main app
 app.include_router(api_router)
 
+PROFILE_FLAG_VALUES = {"1", "true"}
+
+def profile_requested(headers: Headers, query_string: bytes) -> bool:
+    if headers.get("x-profile", "").lower() in PROFILE_FLAG_VALUES:
+        return True
+    if b"profile=" in query_string:
+        return QueryParams(query_string).get("profile", "").lower() in PROFILE_FLAG_VALUES
+    return False
+
+async def is_profiling_admin(headers: Headers) -> bool:
+    scheme, _, token = headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return False
+    credentials = HTTPAuthorizationCredentials(scheme=scheme, credentials=token)
+    try:
+        await get_current_admin(await get_current_user(credentials))
+    except HTTPException:
+        return False
+    return True
+
+async def store_request_profile(document: dict):
+    try:
+        await db.request_profiles.insert_one(document)
+    except PyMongoError:
+        logger.exception("Failed to store request profile %s", document["id"])
+
+# Pending profile writes, referenced so they are not garbage collected mid-flight
+_profile_writes: set = set()
+
+class ProfilingMiddleware:
+    """Profiles admin opt-in requests and a sampled fraction of slow requests.
+
+    Admins opt in per request with an X-Profile header or ?profile=1/true.
+    Otherwise a PROFILE_SAMPLE_RATE fraction of requests is profiled and kept
+    only when slower than PROFILE_SLOW_THRESHOLD_MS. Requests that are not
+    profiled are passed straight through to the app.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        headers = Headers(scope=scope)
+        if profile_requested(headers, scope.get("query_string", b"")) and await is_profiling_admin(headers):
+            reason = "requested"
+        elif PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE:
+            reason = "sampled"
+        else:
+            return await self.app(scope, receive, send)
+
+        profile = RequestProfile(scope["method"], scope["path"], reason)
+        status_code = 500
+
+        async def send_with_profile_id(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                if reason == "requested":
+                    MutableHeaders(scope=message).append("X-Profile-Id", profile.id)
+            await send(message)
+
+        token = _active_profile.set(profile)
+        profile.start()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_profile_id)
+        finally:
+            duration_ms = (time.perf_counter() - started) * 1000
+            profile.stop()
+            _active_profile.reset(token)
+
+        if reason == "sampled" and duration_ms < PROFILE_SLOW_THRESHOLD_MS:
+            return
+        if reason == "sampled":
+            logger.info("Profiled slow request %s %s (%.1f ms): %s", profile.method, profile.path, duration_ms, profile.id)
+
+        # Written in the background so a slow or failing insert never delays
+        # or breaks the response that has already been sent
+        write = asyncio.create_task(store_request_profile({
+            "id": profile.id,
+            "method": profile.method,
+            "path": profile.path,
+            "reason": reason,
+            "status_code": status_code,
+            "duration_ms": duration_ms,
+            "mongo_commands": profile.mongo_commands,
+            "folded": profile.folded(),
+            "created_at": datetime.utcnow()
+        }))
+        _profile_writes.add(write)
+        write.add_done_callback(_profile_writes.discard)
+
+app.add_middleware(ProfilingMiddleware)
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Profile-Id", "Idempotent-Replayed"],
 )
 
 # Configure logging
@@ -431,6 +1027,21 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def create_indexes():
+    await db.request_profiles.create_index("id", unique=True)
+    await db.request_profiles.create_index("created_at", expireAfterSeconds=PROFILE_RETENTION_DAYS * 24 * 60 * 60)
+    await db.idempotency_keys.create_index([("scope", 1), ("key", 1)], unique=True)
+    await db.idempotency_keys.create_index("created_at", expireAfterSeconds=IDEMPOTENCY_KEY_TTL_HOURS * 60 * 60)
+    await db.audit_events.create_index([("created_at", -1), ("_id", -1)])
+    await db.audit_events.create_index([("actor_id", 1), ("created_at", -1)])
+    await db.audit_events.create_index([("target_id", 1), ("created_at", -1)])
+
+@app.on_event("startup")
+async def start_audit_log():
+    audit_log.start()
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    await audit_log.stop()
     client.close()
\ No newline at end of file
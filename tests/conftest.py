@@ -0,0 +1,16 @@
+import sys
+from pathlib import Path
+
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import server  # noqa: E402
+
+
+@pytest.fixture
+def db(monkeypatch):
+    mock_db = AsyncMongoMockClient()["test_database"]
+    monkeypatch.setattr(server, "db", mock_db)
+    return mock_db
@@ -0,0 +1,100 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from pymongo.errors import AutoReconnect
+
+import server
+
+
+@pytest.fixture
+def audit_log(monkeypatch):
+    monkeypatch.setattr(server, "AUDIT_BATCH_SIZE", 3)
+    monkeypatch.setattr(server, "AUDIT_FLUSH_SECONDS", 10)
+    return server.AuditLog()
+
+
+def emit_shift_events(audit_log, count):
+    return [audit_log.emit(server.AuditAction.SHIFT_CREATED, "u1", f"shift-{i}") for i in range(count)]
+
+
+def test_flushes_when_batch_is_full(db, audit_log):
+    async def main():
+        audit_log.start()
+        await asyncio.gather(*emit_shift_events(audit_log, 3))
+        await asyncio.sleep(0.05)
+        count = await db.audit_events.count_documents({})
+        await audit_log.stop()
+        return count
+
+    assert asyncio.run(main()) == 3
+
+
+def test_flushes_on_timer(db, audit_log, monkeypatch):
+    monkeypatch.setattr(server, "AUDIT_FLUSH_SECONDS", 0.05)
+
+    async def main():
+        audit_log.start()
+        await audit_log.emit(server.AuditAction.USER_APPROVED, "admin", "u1")
+        await asyncio.sleep(0.2)
+        count = await db.audit_events.count_documents({})
+        await audit_log.stop()
+        return count
+
+    assert asyncio.run(main()) == 1
+
+
+def test_stop_flushes_pending_events(db, audit_log):
+    async def main():
+        audit_log.start()
+        await asyncio.gather(*emit_shift_events(audit_log, 2))
+        await audit_log.stop()
+        return await db.audit_events.count_documents({})
+
+    assert asyncio.run(main()) == 2
+
+
+def test_writer_survives_unencodable_event(db, audit_log):
+    async def main():
+        audit_log.start()
+        await audit_log.emit(server.AuditAction.SHIFT_DELETED, "u1", "shift-1", bad=object())
+        await asyncio.gather(*emit_shift_events(audit_log, 2))
+        await asyncio.sleep(0.05)
+        await asyncio.gather(*emit_shift_events(audit_log, 3))
+        await asyncio.sleep(0.05)
+        count = await db.audit_events.count_documents({})
+        await audit_log.stop()
+        await audit_log.stop()
+        return count
+
+    assert asyncio.run(main()) == 5
+
+
+def test_transient_write_failure_is_retried(db, audit_log, monkeypatch):
+    monkeypatch.setattr(server, "AUDIT_RETRY_BACKOFF_SECONDS", 0)
+    attempts = []
+
+    async def flaky_insert_many(documents, **kwargs):
+        attempts.append(len(documents))
+        if len(attempts) == 1:
+            raise AutoReconnect("connection reset")
+        return await db.audit_events.insert_many(documents, **kwargs)
+
+    monkeypatch.setattr(server, "db", SimpleNamespace(audit_events=SimpleNamespace(insert_many=flaky_insert_many)))
+
+    async def main():
+        audit_log.start()
+        await asyncio.gather(*emit_shift_events(audit_log, 3))
+        await audit_log.stop()
+        return await db.audit_events.count_documents({})
+
+    assert asyncio.run(main()) == 3
+    assert attempts == [3, 3]
+
+
+def test_emit_before_start_is_dropped(db, audit_log):
+    async def main():
+        await audit_log.emit(server.AuditAction.USER_REJECTED, "admin", "u1")
+        return await db.audit_events.count_documents({})
+
+    assert asyncio.run(main()) == 0
@@ -0,0 +1,140 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse
+
+import server
+
+
+@pytest.fixture(autouse=True)
+def idempotency_index(db):
+    asyncio.run(db.idempotency_keys.create_index([("scope", 1), ("key", 1)], unique=True))
+
+
+def counting_handler(result=None, error=None, delay=0):
+    calls = []
+
+    async def handler():
+        calls.append(1)
+        await asyncio.sleep(delay)
+        if error is not None:
+            raise error
+        return result
+
+    return handler, calls
+
+
+def test_concurrent_duplicates_execute_once():
+    handler, calls = counting_handler({"id": "shift-1"}, delay=0.05)
+
+    async def main():
+        return await asyncio.gather(*[
+            server.run_idempotent("key-1", "create_shift:u1", "fp", handler) for _ in range(3)
+        ])
+
+    results = asyncio.run(main())
+    assert len(calls) == 1
+    assert results[0] == {"id": "shift-1"}
+    for replay in results[1:]:
+        assert isinstance(replay, JSONResponse)
+        assert replay.headers["Idempotent-Replayed"] == "true"
+        assert replay.body == b'{"id":"shift-1"}'
+
+
+def test_stored_http_error_is_replayed():
+    handler, calls = counting_handler(error=HTTPException(status_code=400, detail="Email already registered"))
+
+    async def main():
+        with pytest.raises(HTTPException):
+            await server.run_idempotent("key-1", "register:a@b.com", "fp", handler)
+        return await server.run_idempotent("key-1", "register:a@b.com", "fp", handler)
+
+    replay = asyncio.run(main())
+    assert len(calls) == 1
+    assert replay.status_code == 400
+    assert replay.body == b'{"detail":"Email already registered"}'
+
+
+def test_unexpected_error_releases_key():
+    failing, _ = counting_handler(error=RuntimeError("boom"))
+    handler, calls = counting_handler({"id": "shift-1"})
+
+    async def main():
+        with pytest.raises(RuntimeError):
+            await server.run_idempotent("key-1", "create_shift:u1", "fp", failing)
+        return await server.run_idempotent("key-1", "create_shift:u1", "fp", handler)
+
+    assert asyncio.run(main()) == {"id": "shift-1"}
+    assert len(calls) == 1
+
+
+def test_reused_key_with_different_payload_is_rejected():
+    handler, calls = counting_handler({"id": "shift-1"})
+
+    async def main():
+        await server.run_idempotent("key-1", "create_shift:u1", "fp-1", handler)
+        await server.run_idempotent("key-1", "create_shift:u1", "fp-2", handler)
+
+    with pytest.raises(HTTPException) as exc_info:
+        asyncio.run(main())
+    assert exc_info.value.status_code == 422
+    assert len(calls) == 1
+
+
+def test_expired_claim_is_taken_over(db):
+    handler, calls = counting_handler({"id": "shift-1"})
+
+    async def main():
+        now = datetime.utcnow()
+        await db.idempotency_keys.insert_one({
+            "scope": "create_shift:u1",
+            "key": "key-1",
+            "fingerprint": "fp",
+            "status": "in_progress",
+            "claim_id": "crashed-worker",
+            "locked_until": now - timedelta(seconds=1),
+            "created_at": now - timedelta(seconds=60)
+        })
+        result = await server.run_idempotent("key-1", "create_shift:u1", "fp", handler)
+        return result, await db.idempotency_keys.find_one({"key": "key-1"})
+
+    result, record = asyncio.run(main())
+    assert result == {"id": "shift-1"}
+    assert len(calls) == 1
+    assert record["status"] == "completed"
+    assert record["claim_id"] != "crashed-worker"
+
+
+def test_handler_outliving_lease_runs_once(monkeypatch):
+    monkeypatch.setattr(server, "IDEMPOTENCY_WAIT_SECONDS", 0.2)
+    handler, calls = counting_handler({"id": "shift-1"}, delay=0.5)
+
+    async def main():
+        return await asyncio.gather(*[
+            server.run_idempotent("key-1", "create_shift:u1", "fp", handler) for _ in range(2)
+        ])
+
+    original, replay = asyncio.run(main())
+    assert len(calls) == 1
+    assert original == {"id": "shift-1"}
+    assert replay.body == b'{"id":"shift-1"}'
+
+
+def test_lease_is_renewed_for_waiters_in_other_processes(monkeypatch):
+    monkeypatch.setattr(server, "IDEMPOTENCY_WAIT_SECONDS", 0.2)
+    handler, calls = counting_handler({"id": "shift-1"}, delay=0.5)
+
+    async def main():
+        original = asyncio.create_task(server.run_idempotent("key-1", "create_shift:u1", "fp", handler))
+        await asyncio.sleep(0.05)
+        # Hide the in-process event so the retry behaves like one on another worker
+        monkeypatch.setattr(server, "_idempotency_events", {})
+        replay = await server.run_idempotent("key-1", "create_shift:u1", "fp", handler)
+        return await original, replay
+
+    original, replay = asyncio.run(main())
+    assert len(calls) == 1
+    assert original == {"id": "shift-1"}
+    assert replay.body == b'{"id":"shift-1"}'
@@ -0,0 +1,145 @@
+import time
+import uuid
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+from fastapi.testclient import TestClient
+from starlette.datastructures import Headers
+
+import server
+
+
+def create_user(db_sync, role):
+    user_id = str(uuid.uuid4())
+    db_sync.users.insert_one({
+        "id": user_id,
+        "email": f"{user_id}@doctorshift.com",
+        "password": "unused",
+        "first_name": "Test",
+        "last_name": "User",
+        "phone_number": "0000000000",
+        "medical_license_number": "MD001",
+        "role": role,
+        "approval_status": server.ApprovalStatus.APPROVED,
+        "license_image_path": None,
+        "created_at": datetime.utcnow()
+    })
+    return {"Authorization": f"Bearer {server.create_access_token({'sub': user_id})}"}
+
+
+@pytest.fixture
+def client(db):
+    with TestClient(server.app) as test_client:
+        yield test_client
+
+
+@pytest.fixture
+def admin_headers(db):
+    return create_user(db.delegate, server.UserRole.ADMIN)
+
+
+@pytest.fixture
+def doctor_headers(db):
+    return create_user(db.delegate, server.UserRole.DOCTOR)
+
+
+def stored_profiles(db):
+    # Profiles are written in a background task after the response is sent
+    time.sleep(0.1)
+    return list(db.delegate.request_profiles.find())
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("1", True),
+    ("true", True),
+    ("TRUE", True),
+    ("0", False),
+    ("false", False),
+    ("", False),
+])
+def test_profile_flag_accepts_only_1_or_true(value, expected):
+    assert server.profile_requested(Headers({"x-profile": value}), b"") is expected
+    assert server.profile_requested(Headers(), f"profile={value}".encode()) is expected
+
+
+def test_profile_flag_absent():
+    assert server.profile_requested(Headers(), b"position=surgery") is False
+
+
+def test_non_admin_opt_in_is_not_profiled(db, client, doctor_headers):
+    response = client.get("/api/shifts", headers={**doctor_headers, "X-Profile": "1"})
+    assert response.status_code == 200
+    assert "X-Profile-Id" not in response.headers
+
+    response = client.get("/api/shifts?profile=1")
+    assert response.status_code == 403
+    assert "X-Profile-Id" not in response.headers
+    assert stored_profiles(db) == []
+
+
+def test_admin_opt_in_is_profiled_and_readable(db, client, admin_headers):
+    response = client.get("/api/shifts?profile=1", headers=admin_headers)
+    assert response.status_code == 200
+    profile_id = response.headers["X-Profile-Id"]
+    assert [profile["id"] for profile in stored_profiles(db)] == [profile_id]
+
+    profile = client.get(f"/api/admin/profiles/{profile_id}", headers=admin_headers).json()
+    assert profile["reason"] == "requested"
+    assert profile["path"] == "/api/shifts"
+    assert profile["status_code"] == 200
+
+    folded = client.get(f"/api/admin/profiles/{profile_id}/folded", headers=admin_headers)
+    assert folded.status_code == 200
+    assert folded.headers["content-type"].startswith("text/plain")
+
+
+def test_sampled_fast_requests_are_discarded(db, client, doctor_headers, monkeypatch):
+    monkeypatch.setattr(server, "PROFILE_SAMPLE_RATE", 1.0)
+    monkeypatch.setattr(server, "PROFILE_SLOW_THRESHOLD_MS", 60_000)
+    response = client.get("/api/shifts", headers=doctor_headers)
+    assert response.status_code == 200
+    assert stored_profiles(db) == []
+
+
+def test_sampled_slow_requests_are_kept(db, client, doctor_headers, monkeypatch):
+    monkeypatch.setattr(server, "PROFILE_SAMPLE_RATE", 1.0)
+    monkeypatch.setattr(server, "PROFILE_SLOW_THRESHOLD_MS", 0)
+    response = client.get("/api/shifts", headers=doctor_headers)
+    assert response.status_code == 200
+    assert "X-Profile-Id" not in response.headers
+    profiles = stored_profiles(db)
+    assert [profile["reason"] for profile in profiles] == ["sampled"]
+
+
+def command_event(request_id, name="find", duration_micros=1500):
+    return SimpleNamespace(
+        request_id=request_id,
+        command_name=name,
+        command={name: "shifts"},
+        duration_micros=duration_micros
+    )
+
+
+def test_command_listener_attributes_to_active_profile_only():
+    listener = server.ProfilingCommandListener()
+    profile = server.RequestProfile("GET", "/api/shifts", "requested")
+
+    listener.started(command_event(1))
+    listener.succeeded(command_event(1))
+    assert profile.mongo_commands == []
+
+    token = server._active_profile.set(profile)
+    try:
+        listener.started(command_event(2))
+        listener.started(command_event(3, name="count"))
+        listener.succeeded(command_event(2))
+        listener.failed(command_event(3, name="count", duration_micros=500))
+    finally:
+        server._active_profile.reset(token)
+
+    listener.started(command_event(4))
+    assert profile.mongo_commands == [
+        {"command": "find", "collection": "shifts", "duration_ms": 1.5, "succeeded": True},
+        {"command": "count", "collection": "shifts", "duration_ms": 0.5, "succeeded": False},
+    ]